@@ -71,7 +71,9 @@ class TorchGraph:
     def _trace(self, model, dummy_input):
         training = model.training
         model.eval()
-        kw_args = {}
+        # the traced graph is only used to analyze the topology, so there is
+        # no need to run the model again to check the trace
+        kw_args = {'check_trace': False}
         if torch.__version__ >= '1.6.0':
             # only pytorch with version greater than 1.6.0 has the strict option
             kw_args['strict'] = False
@@ -41,7 +41,9 @@ def fix_mask_conflict(masks, model, dummy_input, traced=None):
         training = model.training
         # We need to trace the model in eval mode
         model.eval()
-        kw_args = {}
+        # the traced graph is only used to analyze the topology, so there is
+        # no need to run the model again to check the trace
+        kw_args = {'check_trace': False}
         if torch.__version__ >= '1.6.0':
             # only pytorch with version greater than 1.6.0 has the strict option
             kw_args['strict'] = False
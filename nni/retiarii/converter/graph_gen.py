@@ -14,7 +14,7 @@ from .op_types import MODULE_EXCEPT_LIST, OpTypeName
 from .utils import (
     _convert_name, build_full_name, _without_shape_info,
     _extract_info_from_trace_node, get_full_name_by_scope_name,
-    is_layerchoice_node, match_node, build_cand_name
+    is_layerchoice_node, match_node, build_cand_name, _clear_cache
 )
 
 
@@ -701,6 +701,8 @@ class GraphConverterWithShape(GraphConverter):
         self.remove_dummy_nodes(ir_model)
         self._initialize_parameters(ir_model)
         self._trace_module(module, module_name, ir_model, dummy_input)
+        # the lookup caches reference the nodes of ir_model, release them
+        _clear_cache()
         return ir_graph, attrs
 
     def _initialize_parameters(self, ir_model: 'Model'):
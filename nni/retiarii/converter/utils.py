@@ -1,21 +1,27 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
+import sys
+import weakref
+from collections import defaultdict
+from functools import lru_cache
+
 from ..operation import Cell
-from ..graph import Model, Node
+from ..graph import Graph, Model, Node
 
 
+# names are interned, as they are mostly used as keys to look up nodes and graphs
 def build_full_name(prefix, name, seq=None):
     if isinstance(name, list):
         name = '__'.join(name)
     if seq is None:
-        return '{}__{}'.format(prefix, name)
+        return sys.intern(f'{prefix}__{name}')
     else:
-        return '{}__{}{}'.format(prefix, name, str(seq))
+        return sys.intern(f'{prefix}__{name}{seq}')
 
 
 def build_cand_name(name, label):
-    return f'layerchoice_{label}_{name}'
+    return sys.intern(f'layerchoice_{label}_{name}')
 
 
 def _convert_name(name: str) -> str:
@@ -33,39 +39,31 @@ def _extract_info_from_trace_node(trace_node):
     ----------
     trace_node: torch._C.Value
     """
-    input_shape = []
-    output_shape = []
-
-    inputs = list(trace_node.inputs())
+    kind = trace_node.kind()
+    parameters = None
 
     # cat input tensors are in a strange place
-    if trace_node.kind() == 'aten::cat':
+    if kind == 'aten::cat':
+        inputs = list(trace_node.inputs())
         input_shape = [input.type().sizes() for input in inputs[0].node().inputs()]
+        parameters = {'dim': inputs[1].toIValue()}
     else:
-        for _input in inputs:
-            input_type = _input.type()
-            if input_type.kind() == 'TensorType':
-                shape = input_type.sizes()
-                if shape:
-                    input_shape.append(shape)
-
-    for _output in trace_node.outputs():
-        output_type = _output.type()
-        if output_type.kind() == 'TensorType':
-            shape = output_type.sizes()
-            if shape:
-                output_shape.append(shape)
+        input_shape = _extract_tensor_shapes(trace_node.inputs())
+    output_shape = _extract_tensor_shapes(trace_node.outputs())
 
     shape_parameters = {
         'input_shape': input_shape,
         'output_shape': output_shape,
     }
+    return shape_parameters, parameters
 
-    if trace_node.kind() == 'aten::cat':
-        parameters = {'dim': inputs[1].toIValue()}
-        return shape_parameters, parameters
-    else:
-        return shape_parameters, None
+
+def _extract_tensor_shapes(values):
+    """
+    Collect the non-empty shapes of the tensor typed values.
+    """
+    tensor_types = (value.type() for value in values)
+    return [shape for shape in (t.sizes() for t in tensor_types if t.kind() == 'TensorType') if shape]
 
 
 def is_layerchoice_node(ir_node: Node):
@@ -75,38 +73,115 @@ def is_layerchoice_node(ir_node: Node):
         return False
 
 
-def get_full_name_by_scope_name(ir_model: Model, scope_names, prefix=''):
-    full_name = prefix
+# Scope resolution is memoized for the model being traced.
+# The model is referenced weakly, so that a new model reusing the same id can never hit stale entries.
+_cache_model_ref = None
+# ids of the layerchoice nodes in the cached model
+_layerchoice_ids = set()
+# names of the non-cell nodes in the cached model and of the scopes under them
+_leaf_names = set()
+# graph name -> node type -> nodes of that type in reversed order
+_graph_type_index = {}
+
+
+def _clear_cache():
+    """
+    Drop all the memoized lookups. The type index references IR nodes,
+    so this should be called once a model is traced to not keep it alive.
+    """
+    global _cache_model_ref
+    _resolve_scope.cache_clear()
+    _resolve_scope_name.cache_clear()
+    _graph_type_index.clear()
+    _leaf_names.clear()
+    _layerchoice_ids.clear()
+    _cache_model_ref = None
+
+
+def _refresh_cache(ir_model: Model):
+    """
+    Drop the memoized lookups if they were computed on another model.
+    """
+    global _cache_model_ref
+    if _cache_model_ref is None or _cache_model_ref() is not ir_model:
+        _clear_cache()
+        _layerchoice_ids.update(id(node) for node in ir_model.get_nodes() if is_layerchoice_node(node))
+        _cache_model_ref = weakref.ref(ir_model)
 
-    for last_scope in range(len(scope_names)):
-        ir_node = ir_model.get_node_by_name(full_name)
-        # check if it's layerchoice
-        if is_layerchoice_node(ir_node):
-            full_name = f'layerchoice_{ir_node.operation.parameters["label"]}_{scope_names[last_scope]}'
-        else:
-            full_name = build_full_name(full_name, scope_names[last_scope])
 
+@lru_cache(maxsize=None)
+def _resolve_scope(prefix, scope_tuple):
+    """
+    Resolve scope names from the last one, so that the shared leading scopes of sibling nodes are only resolved once.
+    """
+    if not scope_tuple:
+        return prefix
+    full_name = _resolve_scope(prefix, scope_tuple[:-1])
+    if full_name not in _leaf_names:
+        ir_node = _cache_model_ref().get_node_by_name(full_name)
+        # check if it's layerchoice
+        if id(ir_node) in _layerchoice_ids:
+            return build_cand_name(scope_tuple[-1], ir_node.operation.parameters['label'])
+        if ir_node is None or isinstance(ir_node.operation, Cell):
+            return build_full_name(full_name, scope_tuple[-1])
+        _leaf_names.add(full_name)
+    # a leaf node has no graph, so nothing (including layerchoice) can be found under it
+    full_name = build_full_name(full_name, scope_tuple[-1])
+    _leaf_names.add(full_name)
     return full_name
 
 
+@lru_cache(maxsize=None)
+def _resolve_scope_name(prefix, scope_name):
+    """
+    Resolve the scope name of a trace node, e.g., '__module.convpool/__module.convpool.1/__module.convpool.1.conv'.
+    Trace nodes in the same module share the scope name, so most of them only cost one cache hit.
+    """
+    tail = scope_name.rpartition('/')[2]
+    if not tail:
+        # node is directly in the forward() of the module under `prefix`
+        return prefix
+    return _resolve_scope(prefix, tuple(tail.split('.')[1:]))
+
+
+def get_full_name_by_scope_name(ir_model: Model, scope_names, prefix=''):
+    _refresh_cache(ir_model)
+    return _resolve_scope(prefix, tuple(scope_names))
+
+
 def match_node(ir_model: Model, torch_node, prefix=''):
     """
     Match the corresponding node of a torch._C.Value
     """
-    scope_names = torch_node.scopeName().split('/')[-1].split('.')[1:]
-    full_name = get_full_name_by_scope_name(ir_model, scope_names, prefix)
+    _refresh_cache(ir_model)
+    full_name = _resolve_scope_name(prefix, torch_node.scopeName())
     # handle the case when node is not nn.Module, but directly used in forward()
     # Because name can't be directly matched, so I use a hacky way.
     # I match the first unshaped node of that kind
     graph = ir_model.graphs.get(full_name)
     if graph is not None:
-        for node in graph.get_nodes_by_type(torch_node.kind()):
-            if not node.operation.attributes['input_shape']:
-                return node
-        return None
+        return _first_unshaped_node(graph, torch_node.kind())
     else:
         return ir_model.get_node_by_name(full_name)
 
 
+def _first_unshaped_node(graph: Graph, node_type: str):
+    """
+    Equivalent to picking the first node without input shape in ``graph.get_nodes_by_type(node_type)``.
+    Shapes are only filled in while tracing, so shaped nodes are dropped from the index once and for all.
+    """
+    type_index = _graph_type_index.get(graph.name)
+    if type_index is None:
+        type_index = defaultdict(list)
+        for node in reversed(graph.hidden_nodes):
+            type_index[node.operation.type].append(node)
+        type_index = _graph_type_index[graph.name] = dict(type_index)
+    candidates = type_index.get(node_type)
+    while candidates and candidates[-1].operation.attributes['input_shape']:
+        candidates.pop()
+    return candidates[-1] if candidates else None
+
+
 def _without_shape_info(node: Node):
-    return not node.operation.attributes['input_shape'] and not node.operation.attributes['output_shape']
+    attributes = node.operation.attributes
+    return not attributes['input_shape'] and not attributes['output_shape']
@@ -2,10 +2,14 @@
 # Licensed under the MIT license.
 
 import logging
+import io
 import os
 import gc
+import functools
 import psutil
 import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import torch
 import torchvision.models as models
@@ -35,6 +39,9 @@ RELATIVE_THRESHOLD = 0.01
 # an absolute threshold to determine whether the final result is correct.
 # The error should meet the RELATIVE_THREHOLD or the ABSOLUTE_THRESHOLD.
 ABSOLUTE_THRESHOLD = 0.0001
+# the outputs are only compared, autograd is not needed for them.
+# torch.inference_mode is only available since torch 1.9
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
 
 
 class BackboneModel1(nn.Module):
@@ -158,9 +165,36 @@ class TupleUnpack_Model(nn.Module):
         return out
 
 
+def device_input(factory, *size):
+    """
+    Create the test input with ``factory`` (e.g., ``torch.ones``) on ``device``.
+    On cuda the tensor is built in pinned host memory, so that the copy to
+    the device does not block.
+    """
+    host = factory(*size, pin_memory=device.type == 'cuda')
+    return host.to(device, non_blocking=True)
+
+
 dummy_input = torch.randn(2, 1, 28, 28)
 SPARSITY = 0.5
-MODEL_FILE, MASK_FILE = './11_model.pth', './l1_mask.pth'
+
+
+def export_to_buffers(pruner):
+    """
+    Export the pruned model and the masks into in-memory buffers instead of
+    files, so no disk I/O is needed and parallel test runs can not collide.
+    """
+    model_buffer, mask_buffer = io.BytesIO(), io.BytesIO()
+    pruner.export_model(model_path=model_buffer, mask_path=mask_buffer)
+    return model_buffer, mask_buffer
+
+
+def rewind(buffer):
+    """
+    Seek the buffer back to the beginning before it is (re)loaded.
+    """
+    buffer.seek(0)
+    return buffer
 
 
 def prune_model_l1(model):
@@ -170,7 +204,18 @@ def prune_model_l1(model):
     }]
     pruner = L1FilterPruner(model, config_list)
     pruner.compress()
-    pruner.export_model(model_path=MODEL_FILE, mask_path=MASK_FILE)
+    return export_to_buffers(pruner)
+
+
+@functools.lru_cache(maxsize=1)
+def pretrained_state_dict(model_name, kwargs_tuple):
+    """
+    Cache the (pretrained) weights of the torchvision model, so that all the
+    prune configs tested on a model share a single download/initialization.
+    The cache only keeps the latest model to bound the memory usage.
+    """
+    Model = getattr(models, model_name)
+    return Model(**dict(kwargs_tuple)).state_dict()
 
 
 def generate_random_sparsity(model):
@@ -182,12 +227,13 @@ def generate_random_sparsity(model):
         # layer out
         _start = 0.01
         _end = 0.3
+    conv_names = [name for name, module in model.named_modules()
+                  if isinstance(module, nn.Conv2d)]
+    sparsities = np.random.uniform(_start, _end, size=len(conv_names))
     cfg_list = []
-    for name, module in model.named_modules():
-        if isinstance(module, nn.Conv2d):
-            sparsity = np.random.uniform(_start, _end)
-            cfg_list.append({'op_types': ['Conv2d'], 'op_names': [name],
-                             'sparsity': sparsity})
+    for name, sparsity in zip(conv_names, sparsities):
+        cfg_list.append({'op_types': ['Conv2d'], 'op_names': [name],
+                         'sparsity': float(sparsity)})
     return cfg_list
 
 
@@ -203,27 +249,33 @@ def generate_random_sparsity_v2(model):
         # layer out
         _start = 0.01
         _end = 0.3
+    conv_names = [name for name, module in model.named_modules()
+                  if isinstance(module, nn.Conv2d)]
+    keeps = np.random.uniform(0, 1.0, size=len(conv_names)) > 0.5
+    sparsities = np.random.uniform(_start, _end, size=len(conv_names))
     cfg_list = []
-    for name, module in model.named_modules():
-        if isinstance(module, nn.Conv2d):
-            if np.random.uniform(0, 1.0) > 0.5:
-                sparsity = np.random.uniform(_start, _end)
-                cfg_list.append({'op_types': ['Conv2d'], 'op_names': [name],
-                                 'sparsity': sparsity})
+    for name, keep, sparsity in zip(conv_names, keeps, sparsities):
+        if keep:
+            cfg_list.append({'op_types': ['Conv2d'], 'op_names': [name],
+                             'sparsity': float(sparsity)})
     return cfg_list
 
 
 def zero_bn_bias(model):
+    bn_modules = [module for module in model.modules()
+                  if isinstance(module, (nn.BatchNorm1d, nn.BatchNorm2d, nn.BatchNorm3d))]
+    tensors = [module.bias for module in bn_modules] + \
+        [module.running_mean for module in bn_modules]
+    if not tensors:
+        # e.g. alexnet and vgg have no batchnorm, and the foreach ops
+        # reject an empty tensor list
+        return
     with torch.no_grad():
-        for name, module in model.named_modules():
-            if isinstance(module, nn.BatchNorm2d) \
-                    or isinstance(module, nn.BatchNorm3d) \
-                    or isinstance(module, nn.BatchNorm1d):
-                shape = module.bias.data.size()
-                device = module.bias.device
-                module.bias.data = torch.zeros(shape).to(device)
-                shape = module.running_mean.data.size()
-                module.running_mean = torch.zeros(shape).to(device)
+        if hasattr(torch, '_foreach_zero_'):
+            torch._foreach_zero_(tensors)
+        else:
+            for tensor in tensors:
+                tensor.zero_()
 
 
 class L1ChannelMasker(WeightMasker):
@@ -240,12 +292,12 @@ class L1ChannelMasker(WeightMasker):
             bias = wrapper.module.bias.data
 
         if wrapper.weight_mask is None:
-            mask_weight = torch.ones(weight.size()).type_as(weight).detach()
+            mask_weight = torch.ones_like(weight)
         else:
             mask_weight = wrapper.weight_mask.clone()
         if bias is not None:
             if wrapper.bias_mask is None:
-                mask_bias = torch.ones(bias.size()).type_as(bias).detach()
+                mask_bias = torch.ones_like(bias)
             else:
                 mask_bias = wrapper.bias_mask.clone()
         else:
@@ -260,20 +312,20 @@ class L1ChannelMasker(WeightMasker):
         w_abs = weight.abs()
         if wrapper.type == 'Conv2d':
             w_abs_structured = w_abs.sum((0, 2, 3))
-            threshold = torch.topk(
-                w_abs_structured, num_prune, largest=False)[0].max()
-            mask_weight = torch.gt(w_abs_structured, threshold)[
-                None, :, None, None].expand_as(weight).type_as(weight)
-            return {'weight_mask': mask_weight.detach()}
+            threshold = torch.kthvalue(w_abs_structured, num_prune).values
+            mask_1d = (w_abs_structured > threshold).to(weight.dtype)
+            # ModelSpeedup updates the weight masks in place, so they must not
+            # be broadcast views; the cast is still only done on the 1-D mask
+            mask_weight = mask_1d.view(1, -1, 1, 1).expand_as(weight).contiguous()
+            return {'weight_mask': mask_weight}
         else:
             # Linear
             assert wrapper.type == 'Linear'
             w_abs_structured = w_abs.sum((0))
-            threshold = torch.topk(
-                w_abs_structured, num_prune, largest=False)[0].max()
-            mask_weight = torch.gt(w_abs_structured, threshold)[
-                None, :].expand_as(weight).type_as(weight)
-            return {'weight_mask': mask_weight.detach(), 'bias_mask': mask_bias}
+            threshold = torch.kthvalue(w_abs_structured, num_prune).values
+            mask_1d = (w_abs_structured > threshold).to(weight.dtype)
+            mask_weight = mask_1d.view(1, -1).expand_as(weight).contiguous()
+            return {'weight_mask': mask_weight, 'bias_mask': mask_bias}
 
 
 class L1ChannelPruner(DependencyAwarePruner):
@@ -298,25 +350,94 @@ def channel_prune(model):
     masker = L1ChannelMasker(model, pruner)
     pruner.masker = masker
     pruner.compress()
-    pruner.export_model(model_path=MODEL_FILE, mask_path=MASK_FILE)
+    return export_to_buffers(pruner)
+
+
+def speedup_integration_one(model_name, speedup_cfg, num_threads=None):
+    """
+    Test the speedup of the torchvision model ``model_name`` with all the
+    random sparsity generators. It is a module-level function so that
+    ``SpeedupTestCase.speedup_integration`` can run it in worker processes.
+    """
+    if num_threads is not None:
+        # avoid oversubscribing the cores shared with the other workers
+        torch.set_num_threads(num_threads)
+    for gen_cfg_func in [generate_random_sparsity, generate_random_sparsity_v2]:
+        kwargs = {
+            'pretrained': True
+        }
+        if model_name == 'resnet50':
+            # testing multiple groups
+            kwargs = {
+                'pretrained': False,
+                'groups': 4
+            }
+        Model = getattr(models, model_name)
+        state_dict = pretrained_state_dict(model_name, tuple(sorted(kwargs.items())))
+        kwargs['pretrained'] = False
+        net = Model(**kwargs)
+        net.load_state_dict(state_dict)
+        net.to(device)
+        speedup_model = Model(**kwargs).to(device)
+        net.eval()  # this line is necessary
+        speedup_model.eval()
+        # random generate the prune config for the pruner
+        cfgs = gen_cfg_func(net)
+        print("Testing {} with compression config \n {}".format(
+            model_name, cfgs))
+        if len(cfgs) == 0:
+            continue
+        pruner = L1FilterPruner(net, cfgs)
+        pruner.compress()
+        model_buffer, mask_buffer = export_to_buffers(pruner)
+        pruner._unwrap_model()
+        speedup_model.load_state_dict(torch.load(rewind(model_buffer)))
+        zero_bn_bias(net)
+        zero_bn_bias(speedup_model)
+
+        data = device_input(torch.ones, BATCH_SIZE, 3, 128, 128)
+        ms = ModelSpeedup(speedup_model, data,
+                          torch.load(rewind(mask_buffer)), confidence=4, **speedup_cfg)
+
+        ms.speedup_model()
+
+        speedup_model.eval()
+
+        with inference_mode():
+            ori_out = net(data)
+            speeded_out = speedup_model(data)
+        ori_sum = torch.sum(ori_out).item()
+        speeded_sum = torch.sum(speeded_out).item()
+        print('Sum of the output of %s (before speedup):' %
+              model_name, ori_sum)
+        print('Sum of the output of %s (after  speedup):' %
+              model_name, speeded_sum)
+        assert (abs(ori_sum - speeded_sum) / abs(ori_sum) < RELATIVE_THRESHOLD) or \
+            (abs(ori_sum - speeded_sum) < ABSOLUTE_THRESHOLD)
+        print("Collecting Garbage")
+        gc.collect(2)
 
 
 class SpeedupTestCase(TestCase):
 
     def test_speedup_bigmodel(self):
-        prune_model_l1(BigModel())
+        _, mask_buffer = prune_model_l1(BigModel())
         model = BigModel()
-        apply_compression_results(model, MASK_FILE, 'cpu')
+        apply_compression_results(model, rewind(mask_buffer), 'cpu')
         model.eval()
-        mask_out = model(dummy_input)
+        # the reference output is not reusable across runs: every BigModel()
+        # is randomly initialized, so the masked weights differ each time
+        with inference_mode():
+            mask_out = model(dummy_input)
 
         model.train()
-        ms = ModelSpeedup(model, dummy_input, MASK_FILE, confidence=8)
+        ms = ModelSpeedup(model, dummy_input, torch.load(rewind(mask_buffer)), confidence=8)
         ms.speedup_model()
         assert model.training
 
         model.eval()
-        speedup_out = model(dummy_input)
+        with inference_mode():
+            speedup_out = model(dummy_input)
         if not torch.allclose(mask_out, speedup_out, atol=1e-07):
             print('input:', dummy_input.size(),
                   torch.abs(dummy_input).sum((2, 3)))
@@ -342,17 +463,18 @@ class SpeedupTestCase(TestCase):
         pruner = L1FilterPruner(ori_model, config_list)
         pruner.compress()
         ori_model(dummy_input)
-        pruner.export_model(MODEL_FILE, MASK_FILE)
+        model_buffer, mask_buffer = export_to_buffers(pruner)
         pruner._unwrap_model()
         new_model = TransposeModel()
-        state_dict = torch.load(MODEL_FILE)
+        state_dict = torch.load(rewind(model_buffer))
         new_model.load_state_dict(state_dict)
-        ms = ModelSpeedup(new_model, dummy_input, MASK_FILE, confidence=8)
+        ms = ModelSpeedup(new_model, dummy_input, torch.load(rewind(mask_buffer)), confidence=8)
         ms.speedup_model()
         zero_bn_bias(ori_model)
         zero_bn_bias(new_model)
-        ori_out = ori_model(dummy_input)
-        new_out = new_model(dummy_input)
+        with inference_mode():
+            ori_out = ori_model(dummy_input)
+            new_out = new_model(dummy_input)
         ori_sum = torch.sum(ori_out)
         speeded_sum = torch.sum(new_out)
         print('Tanspose Speedup Test: ori_sum={} speedup_sum={}'.format(
@@ -362,7 +484,9 @@ class SpeedupTestCase(TestCase):
 
     def test_speedup_integration_small(self):
         model_list = ['resnet18', 'mobilenet_v2', 'alexnet']
-        self.speedup_integration(model_list)
+        ava_gb = psutil.virtual_memory().available/1024.0/1024/1024
+        # each worker process re-imports torch and loads a model, give every one of them 4GB
+        self.speedup_integration(model_list, max_workers=int(ava_gb // 4.0))
 
     def test_speedup_integration_big(self):
         # TODO: will revert vgg16, resnet50, wide_resnet50_2 after confidence refactor
@@ -374,80 +498,48 @@ class SpeedupTestCase(TestCase):
             # memory size is too small that we may run into an OOM exception
             # Skip this test in the pipeline test due to memory limitation
             return
-        self.speedup_integration(model_list)
+        # each worker tests a big model, give every one of them 8GB
+        self.speedup_integration(model_list, max_workers=int(ava_gb // 8.0))
 
-    def speedup_integration(self, model_list, speedup_cfg=None):
+    def speedup_integration(self, model_list, speedup_cfg=None, max_workers=1):
         # Note: hack trick, may be updated in the future
         if 'win' in sys.platform or 'Win'in sys.platform:
             print('Skip test_speedup_integration on windows due to memory limit!')
             return
-        Gen_cfg_funcs = [generate_random_sparsity, generate_random_sparsity_v2]
-
+        if speedup_cfg is None:
+            speedup_cfg = {}
         # for model_name in ['vgg16', 'resnet18', 'mobilenet_v2', 'squeezenet1_1', 'densenet121',
         #                    # 'inception_v3' inception is too large and may fail the pipeline
         #                     'resnet50']:
-        for model_name in model_list:
-            for gen_cfg_func in Gen_cfg_funcs:
-                kwargs = {
-                    'pretrained': True
-                }
-                if model_name == 'resnet50':
-                    # testing multiple groups
-                    kwargs = {
-                        'pretrained': False,
-                        'groups': 4
-                    }
-                Model = getattr(models, model_name)
-                net = Model(**kwargs).to(device)
-                speedup_model = Model(**kwargs).to(device)
-                net.eval()  # this line is necessary
-                speedup_model.eval()
-                # random generate the prune config for the pruner
-                cfgs = gen_cfg_func(net)
-                print("Testing {} with compression config \n {}".format(
-                    model_name, cfgs))
-                if len(cfgs) == 0:
-                    continue
-                pruner = L1FilterPruner(net, cfgs)
-                pruner.compress()
-                pruner.export_model(MODEL_FILE, MASK_FILE)
-                pruner._unwrap_model()
-                state_dict = torch.load(MODEL_FILE)
-                speedup_model.load_state_dict(state_dict)
-                zero_bn_bias(net)
-                zero_bn_bias(speedup_model)
-
-                data = torch.ones(BATCH_SIZE, 3, 128, 128).to(device)
-                if speedup_cfg is None:
-                    speedup_cfg = {}
-                ms = ModelSpeedup(speedup_model, data,
-                                  MASK_FILE, confidence=4, **speedup_cfg)
-
-                ms.speedup_model()
-
-                speedup_model.eval()
-
-                ori_out = net(data)
-                speeded_out = speedup_model(data)
-                ori_sum = torch.sum(ori_out).item()
-                speeded_sum = torch.sum(speeded_out).item()
-                print('Sum of the output of %s (before speedup):' %
-                      model_name, ori_sum)
-                print('Sum of the output of %s (after  speedup):' %
-                      model_name, speeded_sum)
-                assert (abs(ori_sum - speeded_sum) / abs(ori_sum) < RELATIVE_THRESHOLD) or \
-                    (abs(ori_sum - speeded_sum) < ABSOLUTE_THRESHOLD)
-                print("Collecting Garbage")
-                gc.collect(2)
+        cpu_count = os.cpu_count() or 1
+        n_workers = min(max_workers, cpu_count, len(model_list))
+        if n_workers <= 1 or device.type == 'cuda' or sys.version_info < (3, 7):
+            # the workers would share one gpu whose memory is never checked, so
+            # the models are only tested in parallel on cpu. they are tested in
+            # spawned processes, which ProcessPoolExecutor only supports since
+            # python 3.7
+            for model_name in model_list:
+                speedup_integration_one(model_name, speedup_cfg)
+            return
+        # spawn instead of fork: forking after torch has started its thread pools
+        # (or initialized cuda) may hang the workers
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(speedup_integration_one, model_name, speedup_cfg,
+                                       max(1, cpu_count // n_workers))
+                       for model_name in model_list]
+            for future in as_completed(futures):
+                # re-raise the assertion errors of the workers
+                future.result()
 
     def test_channel_prune(self):
         orig_net = resnet18(num_classes=10).to(device)
-        channel_prune(orig_net)
-        state_dict = torch.load(MODEL_FILE)
+        model_buffer, mask_buffer = channel_prune(orig_net)
+        state_dict = torch.load(rewind(model_buffer))
 
         orig_net = resnet18(num_classes=10).to(device)
         orig_net.load_state_dict(state_dict)
-        apply_compression_results(orig_net, MASK_FILE)
+        apply_compression_results(orig_net, rewind(mask_buffer))
         orig_net.eval()
 
         net = resnet18(num_classes=10).to(device)
@@ -455,15 +547,16 @@ class SpeedupTestCase(TestCase):
         net.load_state_dict(state_dict)
         net.eval()
 
-        data = torch.randn(BATCH_SIZE, 3, 128, 128).to(device)
-        ms = ModelSpeedup(net, data, MASK_FILE, confidence=8)
+        data = device_input(torch.randn, BATCH_SIZE, 3, 128, 128)
+        ms = ModelSpeedup(net, data, torch.load(rewind(mask_buffer)), confidence=8)
         ms.speedup_model()
         ms.bound_model(data)
 
         net.eval()
 
-        ori_sum = orig_net(data).abs().sum().item()
-        speeded_sum = net(data).abs().sum().item()
+        with inference_mode():
+            ori_sum = orig_net(data).abs().sum().item()
+            speeded_sum = net(data).abs().sum().item()
 
         print(ori_sum, speeded_sum)
         assert (abs(ori_sum - speeded_sum) / abs(ori_sum) < RELATIVE_THRESHOLD) or \
@@ -477,8 +570,8 @@ class SpeedupTestCase(TestCase):
         pruner = L1FilterPruner(model, cfg_list)
         pruner.compress()
         model(dummy_input)
-        pruner.export_model(MODEL_FILE, MASK_FILE)
-        ms = ModelSpeedup(model, dummy_input, MASK_FILE, confidence=8)
+        _, mask_buffer = export_to_buffers(pruner)
+        ms = ModelSpeedup(model, dummy_input, torch.load(rewind(mask_buffer)), confidence=8)
         ms.speedup_model()
 
     def test_finegrained_speedup(self):
@@ -499,24 +592,20 @@ class SpeedupTestCase(TestCase):
                 x = self.fc4(x)
                 return x
         model = MLP().to(device)
-        dummy_input = torch.rand(16, 1, 32, 32).to(device)
+        dummy_input = device_input(torch.rand, 16, 1, 32, 32)
         cfg_list = [{'op_types': ['Linear'], 'sparsity':0.99}]
         pruner = LevelPruner(model, cfg_list)
         pruner.compress()
         print('Original Arch')
         print(model)
-        pruner.export_model(MODEL_FILE, MASK_FILE)
+        _, mask_buffer = export_to_buffers(pruner)
         pruner._unwrap_model()
-        ms = ModelSpeedup(model, dummy_input, MASK_FILE, confidence=8)
+        ms = ModelSpeedup(model, dummy_input, torch.load(rewind(mask_buffer)), confidence=8)
         ms.speedup_model()
         print("Fine-grained speeduped model")
         print(model)
 
     def tearDown(self):
-        if os.path.exists(MODEL_FILE):
-            os.remove(MODEL_FILE)
-        if os.path.exists(MASK_FILE):
-            os.remove(MASK_FILE)
         # GC to release memory
         gc.collect(2)
 